@@ -1,102 +1,244 @@
-import asyncio, inspect, re
+import asyncio, functools, inspect, time, uuid
+from collections import deque
+from collections.abc import Mapping
+_STATUS, _now, _clock_ns = ("OK", "TIMEOUT", "ERR"), time.time, time.perf_counter_ns
+_eager_task = getattr(asyncio, "eager_task_factory", None)
 class State:
-    def __init__(self, data=None, async_safe: bool = False):
-        self._data, self._lock = data or {}, (asyncio.Lock() if async_safe else None)
-    async def _do(self, fn):
-        if self._lock:
-            async with self._lock: return fn()
-        return fn()
-    async def get(self, key: str, default=None):
-        return await self._do(lambda: self._data.get(key, default))
-    async def set(self, key: str, value) -> None:
-        await self._do(lambda: self._data.__setitem__(key, value))
-    async def update(self, key: str, fn) -> None:
-        await self._do(lambda: self._data.__setitem__(key, fn(self._data.get(key))))
+    """Per-run data container with optional bounded tracing.
+
+    Args:
+        data: Initial key/value data.
+        async_safe: Accepted for compatibility; get/set/update never suspend mid-operation.
+        trace_id: Identifier for this run's trace; a random hex id is generated on first access if omitted.
+        max_trace: Ring-buffer size for traced events; ``0`` disables tracing.
+    """
+    __slots__ = ("_data", "_trace_id", "trace", "_trace_enabled")
+    def __init__(self, data=None, async_safe: bool = False, trace_id: str | None = None, max_trace: int = 0):
+        if max_trace < 0: raise ValueError(f"max_trace must be >= 0, got {max_trace}")
+        self._data = data or {}
+        self._trace_id, self._trace_enabled = trace_id, max_trace > 0
+        self.trace = deque(maxlen=max_trace) if max_trace else ()
+    @property
+    def trace_id(self) -> str:
+        """Trace identifier, generated lazily as ``uuid4().hex`` if none was given."""
+        if self._trace_id is None: self._trace_id = uuid.uuid4().hex
+        return self._trace_id
+    async def get(self, key: str, default=None): return self._data.get(key, default)
+    async def set(self, key: str, value) -> None: self._data[key] = value
+    async def update(self, key: str, fn) -> None: self._data[key] = fn(self._data.get(key))
+    def log(self, entry: str, metadata=None) -> None:
+        if self._trace_enabled: self.trace.append((_now(), entry, None, 0, metadata))
+    def _log_raw(self, name: str, status: int, t0: int, metadata=None) -> None:
+        self.trace.append((_now(), name, status, _clock_ns() - t0, metadata))
+    @property
+    def formatted_trace(self) -> list[tuple]:
+        """``(timestamp, event, metadata)`` tuples with node events rendered as ``"name:STATUS:1.234s"``."""
+        return [(ts, ev if st is None else f"{ev}:{_STATUS[st]}:{d / 1e9:.3f}s", m) for ts, ev, st, d, m in self.trace]
 class Node:
+    """Named async step that a Flow expression can reference.
+
+    Args:
+        name: Name used in Flow expressions.
+        fn: Async callable ``fn(state) -> bool``.
+        timeout: Seconds per attempt, or None for no limit.
+        retries: Extra attempts after a failure.
+        raise_errors: Re-raise exceptions instead of returning False.
+        retry_on_false: Also retry when ``fn`` returns a falsy result.
+        register: Add the node to the global registry.
+        fast: Hint that ``fn`` never suspends; all-fast ``&`` groups run inline instead of as tasks.
+        memoize: Execute at most once per ``Flow.run`` (per ``<N>`` iteration) and share the result.
+    """
     _registry: dict[str, "Node"] = {}
-    def __init__(self, name: str, fn, timeout=None, retries: int = 0, raise_errors: bool = False, retry_on_false: bool = False):
+    _version = 0
+    def __init__(self, name: str, fn, timeout=None, retries: int = 0, raise_errors: bool = False,
+                 retry_on_false: bool = False, register: bool = True, fast: bool = False, memoize: bool = False):
         call = getattr(fn, "__call__", None)
         if not (inspect.iscoroutinefunction(fn) or (call and inspect.iscoroutinefunction(call))): raise TypeError(f"fn for node '{name}' must be an async callable")
         if timeout is not None and timeout <= 0: raise ValueError(f"timeout must be > 0, got {timeout}")
         if retries < 0: raise ValueError(f"retries must be >= 0, got {retries}")
-        self.name, self._fn, self._timeout, self._retries, self._raise, self._retry_on_false = name, fn, timeout, retries, raise_errors, retry_on_false; Node._registry[name] = self
+        self.name, self._fn, self._timeout, self._retries, self._raise, self._retry_on_false = name, fn, timeout, retries, raise_errors, retry_on_false
+        self._fast, self._memoize = fast, memoize
+        if register:   # only rebinding a name can make a compiled plan stale; new names cannot
+            if name in Node._registry: Node._version += 1
+            Node._registry[name] = self
+        if timeout is None and retries == 0 and type(self).execute is Node.execute: self.execute = self._execute_once
+    def unregister(self) -> None:
+        """Remove this node from the global registry; a no-op if another node has taken its name."""
+        if Node._registry.get(self.name) is self: del Node._registry[self.name]; Node._version += 1
     async def execute(self, state) -> bool:
+        log = state._log_raw if state._trace_enabled else None
+        fn, timeout, name, wait_for = self._fn, self._timeout, self.name, asyncio.wait_for
         for _ in range(self._retries + 1):
+            t0 = _clock_ns() if log else 0
             try:
-                result = bool(await (asyncio.wait_for(self._fn(state), self._timeout) if self._timeout else self._fn(state)))
+                result = bool(await (wait_for(fn(state), timeout) if timeout else fn(state)))
+                if log: log(name, 0, t0)
                 if result or not self._retry_on_false: return result
-            except asyncio.TimeoutError: pass
+            except asyncio.TimeoutError:
+                if log: log(name, 1, t0)
             except KeyboardInterrupt: raise
-            except Exception:
+            except Exception as e:
+                if log: log(name, 2, t0, {"error": type(e).__name__})
                 if self._raise: raise
         return False
+    async def _execute_once(self, state) -> bool:
+        if state._trace_enabled: return await Node.execute(self, state)
+        try: return bool(await self._fn(state))
+        except asyncio.TimeoutError: return False
+        except Exception:
+            if self._raise: raise
+            return False
 class Flow:
-    _P, _RE = {">>": 1, "|": 2, "?": 2, "&": 3, "<": 4}, re.compile(r"(\(|\)|>>|&|\?|\||<\d+>|[^\s()&|?<>]+)")
-    def __init__(self): self._cache: dict[str, list[str]] = {}
+    """Compiles and runs DSL expressions over registered nodes.
+
+    Args:
+        registry: Name -> Node mapping; defaults to the global ``Node`` registry.
+        eager: Start ``&`` branches as eager tasks on Python 3.12+.
+    """
+    _P = {">>": 1, "|": 2, "?": 2, "&": 3, "<": 4}
+    def __init__(self, registry: Mapping[str, Node] | None = None, eager: bool = True):
+        self._cache: dict[str, object] = {}; self._raw: dict[str, object] = {}
+        self._registry = Node._registry if registry is None else registry
+        self._spawn = _eager_task if eager else None
+        self._ver = Node._version if self._registry is Node._registry else None
     async def run(self, expr: str, state) -> bool:
+        return await self._plan(expr)(state, None)
+    def compile(self, expr: str):
+        """Validate and compile ``expr`` once.
+
+        Returns:
+            An async function ``run(state) -> bool``, usable directly as a Node's ``fn``.
+        """
+        plan = self._plan(expr)
+        async def run(state) -> bool: return await plan(state, None)
+        return run
+    def _plan(self, expr: str):
+        if self._ver is not None and self._ver != Node._version:
+            self._cache.clear(); self._raw.clear(); self._ver = Node._version
+        plan = self._raw.get(expr) if type(expr) is str else None
+        if plan is not None: return plan
         if not isinstance(expr, str): raise TypeError(f"expr must be str, got {type(expr).__name__}")
-        c = re.sub(r"\s+", "", expr or "")
+        c = "".join(expr.split())
         if not c: raise ValueError("expr cannot be empty")
         if c not in self._cache:
-            t = self._RE.findall(c)
-            if "".join(t) != c: raise ValueError(f"Invalid syntax in expression: {expr}")
-            self._validate(t); self._cache[c] = t
-        return (await self._eval(self._cache[c], state))[0]
-    def _validate(self, t: list[str]) -> None:
+            t = self._scan(c)
+            if t is None: raise ValueError(f"Invalid syntax in expression: {expr}")
+            self._validate(t); root = self._compile(t, 0, len(t))
+            if any(self._registry[v]._memoize for kd, v, _ in t if kd == "name"):
+                async def memo_root(s, mo, root=root): return await root(s, {})
+                root = memo_root
+            self._cache[c] = root
+        self._raw[expr] = self._cache[c]; return self._raw[expr]
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _scan(c: str) -> tuple[tuple[str, str, int], ...] | None:
+        t, i, n, P = [], 0, len(c), Flow._P
+        while i < n:
+            ch = c[i]
+            if ch in "()&|?": t.append((ch, ch, P.get(ch, 0))); i += 1; continue
+            if ch == ">":
+                if c[i + 1:i + 2] != ">": return None
+                t.append((">>", ">>", 1)); i += 2; continue
+            j = i + 1
+            if ch == "<":
+                while j < n and c[j].isdecimal(): j += 1
+                if j == i + 1 or c[j:j + 1] != ">": return None
+                t.append(("<", c[i:j + 1], 4)); i = j + 1; continue
+            while j < n and c[j] not in "()&|?<>": j += 1
+            t.append(("name", c[i:j], 0)); i = j
+        return tuple(t)
+    def _validate(self, t) -> None:
         exp, d = True, 0
-        for x in t:
-            op = x in self._P or (x.startswith("<") and x.endswith(">"))
+        for k, x, pr in t:
             if exp:
-                if x == "(": d += 1; continue
-                if x == ")" or op: raise ValueError(f"Expected node or '(', got '{x}'")
-                if x not in Node._registry: raise ValueError(f"Node '{x}' not found in registry. Available: {list(Node._registry.keys())}")
+                if k == "(": d += 1; continue
+                if k != "name": raise ValueError(f"Expected node or '(', got '{x}'")
+                if x not in self._registry:
+                    raise ValueError(f"Node '{x}' not found in registry. Available: {list(self._registry.keys())}")
                 exp = False; continue
-            if x == ")":
+            if k == ")":
                 d -= 1
                 if d < 0: raise ValueError("Unmatched closing parenthesis")
                 continue
-            if op:
-                if x.startswith("<") and int(x[1:-1]) <= 0: raise ValueError(f"Loop count must be > 0, got {int(x[1:-1])}")
+            if pr:
+                if k == "<" and int(x[1:-1]) <= 0: raise ValueError(f"Loop count must be > 0, got {int(x[1:-1])}")
                 exp = True; continue
             raise ValueError(f"Expected operator or ')', got '{x}'")
         if d != 0: raise ValueError("Unmatched opening parenthesis")
         if exp: raise ValueError("Expression cannot end with an operator")
     @staticmethod
-    def _m(a, b): o = list(a); [o.append(n) for n in b if n not in o]; return tuple(o)
-    async def _eval(self, t: list[str], s, i: int = 0, j=None, p=()):
-        j = len(t) if j is None else j
-        if i >= j: return False, ()
+    def _m(a, b):
+        if not b: return a
+        if not a: return b
+        seen = set(a); return a + tuple(n for n in b if n not in seen and not seen.add(n))
+    def _compile(self, t, i: int, j: int, p: tuple = ()):
         if j - i == 1:
-            n = t[i]
-            if n in Node._registry and n in p: raise RuntimeError(f"Cycle detected: {' >> '.join(p + (n,))}")
-            if n in Node._registry: return await Node._registry[n].execute(s), (n,)
-            return False, ()
-        m, k, d = 999, -1, 0
+            name = t[i][1]
+            if name in p: raise RuntimeError(f"Cycle detected: {' >> '.join(p + (name,))}")
+            return self._leaf(name, self._registry[name])
+        m, ks, d = 999, [], 0
         for x in range(i, j):
-            if t[x] == "(": d += 1
-            elif t[x] == ")": d -= 1
-            elif d == 0 and (t[x] in self._P or t[x].startswith("<")):
-                pr = 4 if t[x].startswith("<") else self._P[t[x]]
-                if pr <= m: m, k = pr, x
-        if k == -1: return await self._eval(t, s, i + 1, j - 1, p)
-        op = t[k]
-        if op.startswith("<"):
-            n, last, seen = int(op[1:-1]), False, ()
-            for _ in range(n):
-                _, ln = await self._eval(t, s, i, k, p); r, rn = await self._eval(t, s, k + 1, j, self._m(p, ln))
-                last, seen = r, self._m(seen, self._m(ln, rn))
-                if r: break
-            return last, seen
-        if op == "&":
-            (lr, ln), (rr, rn) = await asyncio.gather(self._eval(t, s, i, k, p), self._eval(t, s, k + 1, j, p))
-            return lr and rr, self._m(ln, rn)
-        lr, ln = await self._eval(t, s, i, k, p)
-        if op == ">>":
-            rr, rn = await self._eval(t, s, k + 1, j, self._m(p, ln)); return rr, self._m(ln, rn)
-        if op == "?":
-            if not lr: return False, ln
-            rr, rn = await self._eval(t, s, k + 1, j, self._m(p, ln)); return rr, self._m(ln, rn)
-        if op == "|":
-            if lr: return lr, ln
-            rr, rn = await self._eval(t, s, k + 1, j, self._m(p, ln)); return rr, self._m(ln, rn)
-        return False, ln
+            kd, _, pr = t[x]
+            if kd == "(": d += 1
+            elif kd == ")": d -= 1
+            elif d == 0 and pr:
+                if pr < m: m, ks = pr, [x]
+                elif pr == m: ks.append(x)
+        if not ks: return self._compile(t, i + 1, j - 1, p)
+        k, after = ks[-1], lambda x, y: self._m(p, tuple(dict.fromkeys(v for kd, v, _ in t[x:y] if kd == "name")))
+        if t[k][0] in ("&", ">>"):
+            bounds = list(zip([i] + [x + 1 for x in ks], ks + [j]))
+            if t[k][0] == ">>":
+                cs = [self._compile(t, x, y, after(i, x - 1) if x > i else p) for x, y in bounds]
+                async def run(s, mo):
+                    r = False
+                    for c in cs: r = await c(s, mo)
+                    return r
+                return run
+            cs = [self._compile(t, x, y, p) for x, y in bounds]
+            spawn, fast = self._spawn, all(self._registry[v]._fast for kd, v, _ in t[i:j] if kd == "name")
+            async def run(s, mo):
+                if fast:   # inline, but like gather: every branch runs and the first error is re-raised
+                    ok, err = True, None
+                    for c in cs:
+                        try: ok = await c(s, mo) and ok
+                        except Exception as e: err = err or e
+                    if err is not None: raise err
+                    return ok
+                cos = [c(s, mo) for c in cs]
+                if spawn: loop = asyncio.get_running_loop(); cos = [spawn(loop, co) for co in cos]
+                return all(await asyncio.gather(*cos))
+            return run
+        op, x, _ = t[k]
+        if op == "|" and len(ks) > 1 and t[ks[-2]][0] == "?":
+            q = ks[-2]; c = self._compile(t, i, q, p)
+            a, b = self._compile(t, q + 1, k, after(i, q)), self._compile(t, k + 1, j, after(i, q))
+            async def run(s, mo): return await (a if await c(s, mo) else b)(s, mo)
+            return run
+        a, b = self._compile(t, i, k, p), self._compile(t, k + 1, j, after(i, k))
+        if op == "<":
+            n = int(x[1:-1])
+            async def run(s, mo):
+                for _ in range(n):
+                    it = mo if mo is None else dict(mo)
+                    await a(s, it)
+                    if await b(s, it): return True
+                return False
+        else:
+            stop = {"?": False, "|": True}[op]
+            async def run(s, mo):
+                r = await a(s, mo)
+                return r if r is stop else await b(s, mo)
+        return run
+    @staticmethod
+    def _leaf(name: str, node: Node):
+        ex = node.execute
+        if not node._memoize: return lambda s, mo: ex(s)
+        async def run(s, mo):
+            f = mo.get(name)
+            if f is not None: return await asyncio.shield(f)
+            f = mo[name] = asyncio.get_running_loop().create_future()
+            try: r = await ex(s)
+            except BaseException: f.cancel(); raise
+            f.set_result(r); return r
+        return run
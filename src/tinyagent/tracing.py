@@ -0,0 +1,174 @@
+"""Trace persistence and graph export for TinyAgent.
+
+Optional plugin: the core never imports this module. Traces are written to and
+read back from JSON Lines, one object per State, or converted to execution graphs for
+offline debugging and GNN training data.
+"""
+
+import json, os, queue, threading
+from array import array
+from collections.abc import Iterator
+from .core import _STATUS
+
+def _json_dumps(obj) -> bytes: return (json.dumps(obj) + "\n").encode()
+
+
+def _plain(obj) -> bool:
+    """True if ``obj`` holds only JSON-native values that orjson and json encode to the same data."""
+    t = type(obj)
+    if t is float: return obj - obj == 0   # False for NaN/inf, which json writes as NaN but orjson as null
+    if t is dict: return all(map(_plain, obj.values()))
+    if t is list or t is tuple: return all(map(_plain, obj))
+    return t is str or t is int or t is bool or obj is None
+
+
+try:
+    import orjson
+    # orjson is a speed-up for plain data only. Types json cannot encode (datetime, dataclasses) are passed
+    # through to ``default`` so they fail over to json, which raises TypeError exactly as without the extra;
+    # ints beyond 64 bits take the same route. Output can still differ in formatting (orjson writes compact
+    # separators and raw UTF-8 where json writes ", " and \u escapes), never in the parsed values.
+    _OPT = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    def _reject(obj): raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    def _dumps(obj) -> bytes:
+        try: return orjson.dumps(obj, default=_reject, option=_OPT) + b"\n"
+        except TypeError: return _json_dumps(obj)
+    def _loads(line: bytes):
+        try: return orjson.loads(line)
+        except orjson.JSONDecodeError: return json.loads(line)
+except ImportError:
+    _dumps, _loads = _json_dumps, json.loads
+
+class TraceWriter:
+    """Append State traces to a JSONL file with batched writes.
+
+    The file is opened once on ``__enter__`` without Python-level buffering; serialized
+    lines are buffered here and joined into a single ``write`` every ``batch_size`` traces
+    and on exit.
+    Serialization uses ``orjson`` when installed and the stdlib ``json`` otherwise.
+
+    Args:
+        path: Destination file, opened in append mode.
+        batch_size: Number of traces buffered before a write.
+        fsync: Call ``os.fsync`` after every batch write so flushed traces survive a crash.
+    """
+
+    def __init__(self, path, batch_size: int = 64, fsync: bool = False):
+        if batch_size <= 0: raise ValueError(f"batch_size must be > 0, got {batch_size}")
+        self.path, self.batch_size, self.fsync, self._buf, self._fh = path, batch_size, fsync, [], None
+
+    def __enter__(self) -> "TraceWriter":
+        self._fh = open(self.path, "ab", buffering=0)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def add(self, state, clear: bool = False) -> None:
+        """Serialize ``state.trace`` now and queue it for the next batch write.
+
+        With ``clear=True`` the exported events are dropped from the State afterwards, so
+        adding the same State again later writes only the events recorded in between.
+        """
+        if self._fh is None: raise RuntimeError("TraceWriter must be used as a context manager")
+        events = [{"timestamp": ts, "name": n, "status": None if st is None else _STATUS[st], "duration_ns": d,
+                   "metadata": m} for ts, n, st, d, m in state.trace]
+        # metadata with NaN/inf or non-JSON types (UUID, Enum, ...) goes through json so results match the stdlib
+        dumps = _dumps if _dumps is _json_dumps or all(m is None or _plain(m) for *_, m in state.trace) else _json_dumps
+        self._buf.append(dumps({"trace_id": state.trace_id, "events": events}))
+        if clear and events: state.trace.clear()
+        if len(self._buf) >= self.batch_size: self.flush()
+
+    def flush(self) -> None:
+        """Write all buffered traces in one call; on error they stay buffered for the next flush."""
+        if not self._buf: return
+        self._write(b"".join(self._buf)); self._buf.clear()
+
+    def close(self) -> None:
+        if self._fh is None: return
+        try: self.flush()
+        finally: self._fh.close(); self._fh = None
+
+    def _write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view: view = view[self._fh.write(view):]
+        if self.fsync: os.fsync(self._fh.fileno())
+
+
+class BackgroundTraceWriter(TraceWriter):
+    """``TraceWriter`` that performs file writes on a daemon thread.
+
+    ``add`` and ``flush`` only serialize and hand bytes to a queue, so disk I/O never
+    blocks the event loop. The thread coalesces everything queued since its last write
+    into one ``write`` (plus ``fsync`` when enabled). Exiting the context waits until
+    every queued trace is on disk and re-raises any error the thread hit while writing.
+    """
+
+    def __enter__(self) -> "BackgroundTraceWriter":
+        super().__enter__()
+        self._q, self._error = queue.SimpleQueue(), None
+        self._thread = threading.Thread(target=self._drain, name="tinyagent-trace-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    def flush(self) -> None:
+        """Queue all buffered traces for the writer thread without waiting for the write."""
+        if self._buf: self._q.put(b"".join(self._buf)); self._buf.clear()
+
+    def close(self) -> None:
+        if self._fh is None: return
+        try:
+            self.flush(); self._q.put(None); self._thread.join()
+            if self._error is not None: raise self._error
+        finally: self._fh.close(); self._fh = None
+
+    def _drain(self) -> None:
+        q, done = self._q, False
+        while not done:
+            batch = [q.get()]
+            while batch[-1] is not None:
+                try: batch.append(q.get_nowait())
+                except queue.Empty: break
+            if batch[-1] is None: batch.pop(); done = True
+            try:
+                if batch and self._error is None: self._write(b"".join(batch))
+            except Exception as e: self._error = e
+
+
+def read_traces(path) -> Iterator[dict]:
+    """Stream traces written by ``TraceWriter``, one parsed object per line.
+
+    The file is read in binary mode and parsed lazily, so memory stays at one trace
+    regardless of file size. Use ``list(read_traces(path))`` to load everything.
+
+    Args:
+        path: JSONL file to read.
+
+    Yields:
+        ``{"trace_id": ..., "events": [...]}`` dicts; blank lines are skipped.
+    """
+    with open(path, "rb") as fh:
+        for line in fh:
+            if line.strip(): yield _loads(line)
+
+
+def to_graph(trace) -> tuple[list[str], array, array]:
+    """Build a GNN-ready execution graph from raw trace records.
+
+    Node executions are interned to integer ids in first-seen order and each pair of
+    consecutive executions becomes a directed edge. Custom ``State.log`` entries are skipped.
+
+    Args:
+        trace: Raw records, e.g. ``state.trace``, or a loaded trace from ``read_traces``.
+
+    Returns:
+        ``(names, src, dst)``: ``names[i]`` is the node with id ``i``; ``src``/``dst`` are
+        parallel int64 columns in PyTorch Geometric ``edge_index`` layout
+        (``numpy.frombuffer(src, dtype=numpy.int64)`` wraps them without copying).
+    """
+    ids = {}
+    if isinstance(trace, dict):
+        col = [ids.setdefault(e["name"], len(ids)) for e in trace["events"] if e["status"] is not None]
+    else: col = [ids.setdefault(n, len(ids)) for _, n, st, _, _ in trace if st is not None]
+    col = array("q", col)
+    return list(ids), col[:-1], col[1:]
@@ -3,6 +3,7 @@ Tests for tinyagent core – covers all implemented functionality.
 Run with: pytest tests/
 """
 import asyncio
+import inspect
 import pytest
 from tinyagent.core import State, Node, Flow
 
@@ -16,6 +17,18 @@ def fresh_registry():
     Node._registry.clear()
 
 
+def count_compiles(flow):
+    """Record every ``Flow._compile`` call made by ``flow``; returns the live call list."""
+    calls, compile_ = [], flow._compile
+    flow._compile = lambda *args: calls.append(args[1:]) or compile_(*args)
+    return calls
+
+
+def stack_depth():
+    """Number of frames below the caller – grows with each nested coroutine layer."""
+    return len(inspect.stack(0))
+
+
 # ---------------------------------------------------------------------------
 # State tests
 # ---------------------------------------------------------------------------
@@ -77,6 +90,105 @@ class TestState:
             return await state.get("k")
         assert asyncio.run(_run()) == 99
 
+    def test_slots_no_instance_dict(self):
+        state = State(max_trace=5)
+        assert not hasattr(state, "__dict__")
+        with pytest.raises(AttributeError):
+            state.extra = 1
+
+
+# ---------------------------------------------------------------------------
+# Tracing tests
+# ---------------------------------------------------------------------------
+
+class TestTrace:
+    def setup_method(self):
+        fresh_registry()
+
+    def test_disabled_by_default(self):
+        async def _run():
+            async def fn(state): return True
+            state = State()
+            state.log("custom")
+            await Node("n", fn).execute(state)
+            return list(state.trace)
+        assert asyncio.run(_run()) == []
+
+    def test_invalid_max_trace(self):
+        with pytest.raises(ValueError, match="max_trace must be >= 0"):
+            State(max_trace=-1)
+
+    def test_trace_id(self):
+        assert State(trace_id="wf-1").trace_id == "wf-1"
+        assert State().trace_id != State().trace_id
+
+    def test_trace_id_is_lazy_and_stable(self):
+        state = State()
+        assert state._trace_id is None
+        assert state.trace_id == state.trace_id
+
+    def test_node_statuses_recorded(self):
+        async def _run():
+            async def ok(state): return True
+            async def slow(state): await asyncio.sleep(10)
+            async def boom(state): raise RuntimeError("x")
+            state = State(max_trace=10)
+            await Node("ok", ok).execute(state)
+            await Node("slow", slow, timeout=0.01).execute(state)
+            await Node("boom", boom).execute(state)
+            return state
+        state = asyncio.run(_run())
+        assert [(ev, st) for _, ev, st, _, _ in state.trace] == [("ok", 0), ("slow", 1), ("boom", 2)]
+        assert state.trace[2][4] == {"error": "RuntimeError"}
+        events = [ev for _, ev, _ in state.formatted_trace]
+        assert events[0].startswith("ok:OK:") and events[0].endswith("s")
+        assert events[1].startswith("slow:TIMEOUT:") and events[2].startswith("boom:ERR:")
+
+    def test_node_timestamps_are_wall_clock(self):
+        import time
+        async def _run():
+            async def nap(state): await asyncio.sleep(0.01); return True
+            state = State(max_trace=10)
+            before = time.time()
+            await Node("nap", nap).execute(state)
+            return before, state, time.time()
+        before, state, after = asyncio.run(_run())
+        (ts, _, _, dur, _), = state.trace
+        assert before - 0.05 <= ts <= after + 0.05
+        assert dur >= 10_000_000
+
+    def test_one_time_base_for_all_records(self, monkeypatch):
+        monkeypatch.setattr("tinyagent.core._now", lambda: 42.0)
+        async def _run():
+            async def ok(state): return True
+            state = State(max_trace=10)
+            state.log("start")
+            await Node("ok", ok).execute(state)
+            return state
+        assert [ts for ts, *_ in asyncio.run(_run()).trace] == [42.0, 42.0]
+
+    def test_custom_log_entry(self):
+        state = State(max_trace=5)
+        state.log("checkpoint", {"step": 1})
+        (ts, event, metadata), = state.formatted_trace
+        assert event == "checkpoint" and metadata == {"step": 1} and ts > 0
+
+    def test_ring_buffer_is_bounded(self):
+        state = State(max_trace=3)
+        for i in range(10):
+            state.log(f"e{i}")
+        assert [ev for _, ev, _ in state.formatted_trace] == ["e7", "e8", "e9"]
+
+    def test_flow_traces_every_node(self):
+        async def _run():
+            async def a(state): return True
+            async def b(state): return True
+            Node("a", a); Node("b", b)
+            state = State(max_trace=100)
+            await Flow().run("a >> b", state)
+            return [ev for _, ev, _, _, _ in state.trace]
+        assert asyncio.run(_run()) == ["a", "b"]
+
 
 # ---------------------------------------------------------------------------
 # Node tests
@@ -111,6 +223,38 @@ class TestNode:
         Node("my_node", fn)
         assert "my_node" in Node._registry
 
+    def test_register_false_skips_registry(self):
+        async def fn(state): return True
+        Node("private", fn, register=False)
+        assert "private" not in Node._registry
+
+    def test_unregister(self):
+        async def fn(state): return True
+        n = Node("n", fn)
+        n.unregister()
+        assert "n" not in Node._registry
+        n.unregister()   # idempotent
+
+    def test_unregister_keeps_replacement(self):
+        async def fn(state): return True
+        old = Node("n", fn)
+        new = Node("n", fn)
+        old.unregister()
+        assert Node._registry["n"] is new
+
+    def test_subclass_execute_override_is_used(self):
+        class Audited(Node):
+            calls = []
+            async def execute(self, state):
+                Audited.calls.append(self.name)
+                return await super().execute(state)
+        async def _run():
+            async def fn(state): return True
+            Audited("x", fn)
+            return await Flow().run("x", State()), await Flow().run("x", State(max_trace=5))
+        assert asyncio.run(_run()) == (True, True)
+        assert Audited.calls == ["x", "x"]
+
     def test_execute_returns_true(self):
         async def _run():
             async def fn(state): return True
@@ -205,6 +349,28 @@ class TestNode:
         assert result is True
         assert attempts == 3
 
+    def test_default_node_uses_single_shot_path(self):
+        async def fn(state): return True
+        fast = Node("fast", fn)
+        assert fast.execute == fast._execute_once
+        assert "execute" not in vars(Node("slow", fn, retries=1))
+
+    def test_single_shot_path_swallows_errors(self):
+        async def _run():
+            async def boom(state): raise RuntimeError("boom")
+            async def own_timeout(state): raise asyncio.TimeoutError
+            return (await Node("boom", boom).execute(State()),
+                    await Node("t", own_timeout, raise_errors=True).execute(State()))
+        assert asyncio.run(_run()) == (False, False)
+
+    def test_single_shot_path_is_traced(self):
+        async def _run():
+            async def fn(state): return True
+            state = State(max_trace=5)
+            await Node("n", fn).execute(state)
+            return [(ev, st) for _, ev, st, _, _ in state.trace]
+        assert asyncio.run(_run()) == [("n", 0)]
+
     def test_retry_on_false_default_stops_immediately(self):
         """Without retry_on_false, False return stops the loop."""
         async def _run():
@@ -264,6 +430,17 @@ class TestFlowSequential:
             return order
         assert asyncio.run(_run()) == [1, 2, 3]
 
+    def test_sequential_chain_is_flattened(self):
+        async def _run():
+            depths = []
+            async def fn(state): depths.append(stack_depth()); return True
+            for name in "abcde": Node(name, fn)
+            result = await Flow().run("a >> b >> c >> d >> e", State())
+            return result, depths
+        result, depths = asyncio.run(_run())
+        # a nested (((a >> b) >> c) ...) plan would run `a` several frames deeper than `e`
+        assert result is True and len(depths) == 5 and len(set(depths)) == 1
+
 
 # ---------------------------------------------------------------------------
 # Flow tests – parallel
@@ -304,6 +481,122 @@ class TestFlowParallel:
         elapsed = asyncio.run(_run())
         assert elapsed < 0.35   # parallel ~0.2s, not sequential 0.4s
 
+    def test_eager_and_lazy_branches_agree(self):
+        async def _run():
+            order = []
+            async def sync_a(state): order.append("a"); return True
+            async def sync_b(state): order.append("b"); return True
+            async def slow(state): await asyncio.sleep(0.01); order.append("slow"); return True
+            Node("a", sync_a); Node("b", sync_b); Node("slow", slow)
+            results = []
+            for eager in (True, False):
+                order.clear()
+                results.append((await Flow(eager=eager).run("slow & a & b", State()), sorted(order)))
+            return results
+        assert asyncio.run(_run()) == [(True, ["a", "b", "slow"])] * 2
+
+    def test_fast_branches_skip_gather(self, monkeypatch):
+        async def _run():
+            order = []
+            async def a(state): order.append("a"); return True
+            async def b(state): order.append("b"); return False
+            Node("a", a, fast=True); Node("b", b, fast=True)
+            monkeypatch.setattr(asyncio, "gather", None)   # would fail if called
+            return await Flow().run("b & a", State()), order
+        assert asyncio.run(_run()) == (False, ["b", "a"])
+
+    def test_fast_branch_error_still_runs_siblings(self):
+        async def _run():
+            ran = []
+            async def boom(state): raise RuntimeError("boom")
+            async def side(state): ran.append("side"); return True
+            Node("boom", boom, fast=True, raise_errors=True); Node("side", side, fast=True)
+            with pytest.raises(RuntimeError, match="boom"):
+                await Flow().run("boom & side", State())
+            return ran
+        assert asyncio.run(_run()) == ["side"]
+
+    def test_mixed_fast_branches_still_gather(self):
+        async def _run():
+            async def quick(state): return True
+            async def slow(state): await asyncio.sleep(0.2); return True
+            Node("quick", quick, fast=True); Node("s1", slow); Node("s2", slow)
+            import time
+            start = time.time()
+            result = await Flow().run("quick & s1 & s2", State())
+            return result, time.time() - start
+        result, elapsed = asyncio.run(_run())
+        assert result is True and elapsed < 0.35
+
+    def test_parallel_chain_is_flattened(self, monkeypatch):
+        gathers = []
+        gather = asyncio.gather
+        monkeypatch.setattr(asyncio, "gather", lambda *aws, **kw: gathers.append(len(aws)) or gather(*aws, **kw))
+        async def _run():
+            async def fn(state): await asyncio.sleep(0.2); return True
+            Node("a", fn); Node("b", fn); Node("c", fn)
+            import time
+            start = time.time()
+            result = await Flow().run("a & b & c", State())
+            return result, time.time() - start
+        result, elapsed = asyncio.run(_run())
+        assert result is True and elapsed < 0.35
+        assert gathers == [3]   # one gather over three branches, no nested pair
+
+
+# ---------------------------------------------------------------------------
+# Flow tests – memoized nodes
+# ---------------------------------------------------------------------------
+
+class TestFlowMemoize:
+    def setup_method(self):
+        fresh_registry()
+
+    def _flow(self, memoize):
+        calls = []
+        async def featurize(state): calls.append(1); await asyncio.sleep(0.01); return True
+        async def a(state): return True
+        async def b(state): return True
+        Node("feat", featurize, memoize=memoize); Node("a", a); Node("b", b)
+        return calls
+
+    def test_shared_node_runs_once_per_run(self):
+        calls = self._flow(memoize=True)
+        async def _run():
+            flow = Flow()
+            r1 = await flow.run("(feat >> a) & (feat >> b)", State())
+            r2 = await flow.run("(feat >> a) & (feat >> b)", State())
+            return r1, r2
+        assert asyncio.run(_run()) == (True, True)
+        assert len(calls) == 2   # once per run, not once per reference
+
+    def test_unmemoized_node_runs_per_reference(self):
+        calls = self._flow(memoize=False)
+        assert asyncio.run(Flow().run("(feat >> a) & (feat >> b)", State())) is True
+        assert len(calls) == 2
+
+    def test_memoized_failure_is_shared(self):
+        async def _run():
+            calls = []
+            async def flaky(state): calls.append(1); return False
+            async def a(state): return True
+            Node("flaky", flaky, memoize=True); Node("a", a)
+            result = await Flow().run("(flaky | a) & (flaky ? a)", State())
+            return result, len(calls)
+        assert asyncio.run(_run()) == (False, 1)
+
+    def test_loop_iterations_get_fresh_memo_scope(self):
+        async def _run():
+            calls = {"feat": 0, "gen": 0}
+            async def feat(state): calls["feat"] += 1; return True
+            async def gen(state): calls["gen"] += 1; return True
+            async def rev(state): return calls["gen"] >= 3
+            Node("feat", feat, memoize=True); Node("gen", gen, memoize=True); Node("rev", rev)
+            result = await Flow().run("feat & ((feat >> (gen & gen)) <5> rev)", State())
+            return result, calls
+        # gen runs once per iteration (shared within it); feat, started before the loop, is reused
+        assert asyncio.run(_run()) == (True, {"feat": 1, "gen": 3})
+
 
 # ---------------------------------------------------------------------------
 # Flow tests – conditional operators
@@ -370,6 +663,51 @@ class TestFlowConditional:
         result, processed, err = asyncio.run(_run())
         assert result is True and processed is True and err is None
 
+    def test_if_else_skips_else_when_then_fails(self):
+        """validate ? process | handle_error is if/else: a failing process does not trigger handle_error."""
+        async def _run():
+            async def validate(state): return True
+            async def process(state): return False
+            async def handle_error(state): await state.set("error", True); return True
+            Node("validate", validate); Node("process", process); Node("handle_error", handle_error)
+            state = State()
+            result = await Flow().run("validate ? process | handle_error", state)
+            return result, await state.get("error")
+        assert asyncio.run(_run()) == (False, None)
+
+    def test_if_else_runs_else_when_condition_fails(self):
+        async def _run():
+            ran = []
+            async def validate(state): ran.append("validate"); return False
+            async def process(state): ran.append("process"); return True
+            async def handle_error(state): ran.append("handle_error"); return True
+            Node("validate", validate); Node("process", process); Node("handle_error", handle_error)
+            result = await Flow().run("validate ? process | handle_error", State())
+            return result, ran
+        assert asyncio.run(_run()) == (True, ["validate", "handle_error"])
+
+    def test_grouped_conditional_keeps_fallback_semantics(self):
+        """(validate ? process) | handle_error still falls back when process fails."""
+        async def _run():
+            async def validate(state): return True
+            async def process(state): return False
+            async def handle_error(state): await state.set("error", True); return True
+            Node("validate", validate); Node("process", process); Node("handle_error", handle_error)
+            state = State()
+            result = await Flow().run("(validate ? process) | handle_error", state)
+            return result, await state.get("error")
+        assert asyncio.run(_run()) == (True, True)
+
+    def test_if_else_chained_fallback(self):
+        async def _run():
+            ran = []
+            async def no(state): ran.append(len(ran)); return False
+            async def yes(state): ran.append(len(ran)); return True
+            Node("c", no); Node("t", yes); Node("e", no); Node("f", yes)
+            return await Flow().run("c ? t | e | f", State()), len(ran)
+        # if c then t else e, then fall back to f because e failed
+        assert asyncio.run(_run()) == (True, 3)
+
 
 # ---------------------------------------------------------------------------
 # Flow tests – loop operator
@@ -462,6 +800,98 @@ class TestFlowCaching:
             return "a" in flow._cache
         assert asyncio.run(_run()) is True
 
+    def test_public_compile_reuses_plan(self):
+        async def _run():
+            runs = []
+            async def a(state): runs.append(1); return True
+            Node("a", a)
+            flow = Flow()
+            compiled = flow.compile("a")
+            results = [await compiled(State()) for _ in range(3)]
+            return results, len(runs), list(flow._cache)
+        assert asyncio.run(_run()) == ([True, True, True], 3, ["a"])
+
+    def test_compiled_flow_as_sub_flow_node(self):
+        async def _run():
+            order = []
+            async def a(state): order.append("a"); return True
+            async def b(state): order.append("b"); return True
+            async def c(state): order.append("c"); return True
+            Node("a", a); Node("b", b); Node("c", c)
+            Node("sub", Flow().compile("a >> b"))
+            return await Flow().run("sub >> c", State()), order
+        assert asyncio.run(_run()) == (True, ["a", "b", "c"])
+
+    def test_compile_validates_eagerly(self):
+        with pytest.raises(ValueError, match="not found in registry"):
+            Flow().compile("missing")
+
+    def test_repeat_expression_skips_normalisation(self):
+        async def _run():
+            async def a(state): return True
+            async def b(state): return True
+            Node("a", a); Node("b", b)
+            flow = Flow()
+            await flow.run("a >> b", State())
+            await flow.run("a>>b", State())
+            cached = list(flow._cache)
+            flow._cache = None   # any normalised lookup would now fail
+            return await flow.run("a >> b", State()), cached
+        assert asyncio.run(_run()) == (True, ["a>>b"])
+
+    def test_compiles_once_per_expression(self):
+        async def _run():
+            async def a(state): return True
+            async def b(state): return True
+            Node("a", a); Node("b", b)
+            flow = Flow()
+            calls = count_compiles(flow)
+            await flow.run("a >> b", State())
+            first = len(calls)
+            for _ in range(2):
+                await flow.run("a >> b", State())
+            return first, len(calls)
+        first, total = asyncio.run(_run())
+        assert first > 0 and total == first   # compiled on the first run only
+
+    def test_reregistering_a_node_recompiles(self):
+        async def _run():
+            async def yes(state): return True
+            async def no(state): return False
+            Node("a", yes)
+            flow = Flow()
+            first = await flow.run("a", State())
+            Node("a", no)
+            return first, await flow.run("a", State())
+        assert asyncio.run(_run()) == (True, False)
+
+    def test_registering_a_new_name_keeps_cache(self):
+        async def _run():
+            async def fn(state): return True
+            Node("a", fn)
+            flow = Flow()
+            calls = count_compiles(flow)
+            await flow.run("a", State())
+            first = len(calls)
+            Node("unrelated", fn)
+            await flow.run("a", State())
+            return first, len(calls)
+        first, total = asyncio.run(_run())
+        assert total == first
+
+    def test_local_registry_ignores_global_registrations(self):
+        async def _run():
+            async def fn(state): return True
+            flow = Flow(registry={"a": Node("a", fn, register=False)})
+            calls = count_compiles(flow)
+            await flow.run("a", State())
+            first = len(calls)
+            Node("unrelated", fn)
+            await flow.run("a", State())
+            return first, len(calls)
+        first, total = asyncio.run(_run())
+        assert total == first
+
 
 # ---------------------------------------------------------------------------
 # Flow tests – error handling
@@ -489,6 +919,19 @@ class TestFlowErrors:
         with pytest.raises(ValueError, match="parenthesis"):
             asyncio.run(Flow().run("n))", State()))
 
+    def test_invalid_syntax(self):
+        async def fn(state): return True
+        Node("a", fn); Node("b", fn)
+        for expr in ("a > b", "a >>> b", "a <x> b", "a <3 b"):
+            with pytest.raises(ValueError, match="Invalid syntax"):
+                asyncio.run(Flow().run(expr, State()))
+
+    def test_scan_classifies_tokens(self):
+        assert Flow._scan("(a&b)>>c<2>d") == (
+            ("(", "(", 0), ("name", "a", 0), ("&", "&", 3), ("name", "b", 0), (")", ")", 0),
+            (">>", ">>", 1), ("name", "c", 0), ("<", "<2>", 4), ("name", "d", 0),
+        )
+
     def test_empty_expression(self):
         with pytest.raises(ValueError, match="empty"):
             asyncio.run(Flow().run("", State()))
@@ -497,6 +940,25 @@ class TestFlowErrors:
         with pytest.raises(TypeError, match="expr must be str"):
             asyncio.run(Flow().run(42, State()))
 
+    def test_local_registry(self):
+        async def _run():
+            async def a(state): await state.set("ran", True); return True
+            flow = Flow(registry={"a": Node("a", a, register=False)})
+            state = State()
+            return await flow.run("a", state), await state.get("ran")
+        assert asyncio.run(_run()) == (True, True)
+        assert "a" not in Node._registry
+
+    def test_local_registry_missing_node(self):
+        async def fn(state): return True
+        Node("global_only", fn)
+        with pytest.raises(ValueError, match="not found in registry"):
+            asyncio.run(Flow(registry={}).run("global_only", State()))
+
+    def test_path_merge_keeps_order_without_duplicates(self):
+        assert Flow._m(("a", "b"), ("b", "c", "a", "d", "c")) == ("a", "b", "c", "d")
+        assert Flow._m((), ("a",)) == ("a",) and Flow._m(("a",), ()) == ("a",)
+
     def test_cycle_detection(self):
         async def _run():
             async def a(state): return True
@@ -514,6 +976,27 @@ class TestFlowErrors:
         result = asyncio.run(_run())
         assert "Cycle detected" in result
 
+    def test_cycle_detected_before_execution(self):
+        async def _run():
+            ran = []
+            async def a(state): ran.append("a"); return False
+            async def b(state): ran.append("b"); return True
+            Node("a", a); Node("b", b)
+            with pytest.raises(RuntimeError, match="Cycle detected: a >> b >> a"):
+                await Flow().run("a >> b >> a", State())
+            with pytest.raises(RuntimeError, match="Cycle detected"):
+                await Flow().run("a ? (b | a)", State())   # unreachable at runtime, still rejected
+            return ran
+        assert asyncio.run(_run()) == []
+
+    def test_parallel_reuse_is_not_a_cycle(self):
+        async def _run():
+            async def a(state): return True
+            async def b(state): return True
+            Node("a", a); Node("b", b)
+            return await Flow().run("(a >> b) & (a >> b)", State())
+        assert asyncio.run(_run()) is True
+
 
 # ---------------------------------------------------------------------------
 # Integration – realistic pipeline
@@ -0,0 +1,222 @@
+"""
+Tests for tinyagent.tracing – trace persistence and graph export.
+Run with: pytest tests/
+"""
+import asyncio
+import datetime
+import json
+import threading
+import uuid
+import pytest
+from tinyagent.core import State, Node, Flow
+from tinyagent.tracing import BackgroundTraceWriter, TraceWriter, read_traces, to_graph
+
+
+def traced_state(trace_id):
+    """Run a two-node flow on a fresh traced State."""
+    async def _run():
+        async def a(state): return True
+        async def b(state): raise RuntimeError("boom")
+        Node("a", a); Node("b", b)
+        state = State(trace_id=trace_id, max_trace=100)
+        state.log("start", {"k": 1})
+        await Flow().run("a >> b", state)
+        return state
+    return asyncio.run(_run())
+
+
+class TestTraceWriter:
+    def setup_method(self):
+        Node._registry.clear()
+
+    def test_writes_one_line_per_state(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        with TraceWriter(path) as w:
+            w.add(traced_state("t1"))
+            w.add(traced_state("t2"))
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [t["trace_id"] for t in lines] == ["t1", "t2"]
+        events = lines[0]["events"]
+        assert [(e["name"], e["status"]) for e in events] == [("start", None), ("a", "OK"), ("b", "ERR")]
+        assert events[0]["metadata"] == {"k": 1}
+        assert events[2]["metadata"] == {"error": "RuntimeError"}
+
+    def test_buffers_until_batch_size(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        with TraceWriter(path, batch_size=2) as w:
+            w.add(traced_state("t1"))
+            assert path.read_text() == ""
+            w.add(traced_state("t2"))
+            assert len(path.read_text().splitlines()) == 2
+
+    def test_appends_to_existing_file(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        for tid in ("t1", "t2"):
+            with TraceWriter(path) as w:
+                w.add(traced_state(tid))
+        assert len(path.read_text().splitlines()) == 2
+
+    def test_clear_exports_incrementally(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        state = traced_state("t1")
+        with TraceWriter(path) as w:
+            w.add(state, clear=True)
+            assert len(state.trace) == 0
+            state.log("later")
+            w.add(state)
+        first, second = [json.loads(line) for line in path.read_text().splitlines()]
+        assert len(first["events"]) == 3
+        assert [e["name"] for e in second["events"]] == ["later"]
+        assert first["trace_id"] == second["trace_id"] == "t1"
+
+    def test_metadata_matches_stdlib_json(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        meta = {1: "x", "big": 2 ** 70, "nested": {2.5: None}}
+        state = State(trace_id="t1", max_trace=5)
+        state.log("step", meta)
+        with TraceWriter(path) as w:
+            w.add(state)
+        event, = next(read_traces(path))["events"]
+        assert event["metadata"] == json.loads(json.dumps(meta))
+
+    @pytest.mark.parametrize("meta", [{"loss": float("nan"), "best": float("inf")}, {"text": "café ✓"},
+                                      {"id": uuid.UUID(int=1)}, {"at": datetime.datetime(2024, 1, 1)}])
+    def test_orjson_matches_stdlib_json(self, tmp_path, meta):
+        pytest.importorskip("orjson")
+        state = State(trace_id="t1", max_trace=5)
+        state.log("step", meta)
+        try: expected = json.dumps(meta)
+        except TypeError:
+            with pytest.raises(TypeError), TraceWriter(tmp_path / "traces.jsonl") as w:
+                w.add(state)
+            return
+        with TraceWriter(tmp_path / "traces.jsonl") as w:
+            w.add(state)
+        event, = next(read_traces(tmp_path / "traces.jsonl"))["events"]
+        assert repr(event["metadata"]) == repr(json.loads(expected))
+
+    def test_fsync_after_each_batch(self, tmp_path, monkeypatch):
+        synced = []
+        monkeypatch.setattr("tinyagent.tracing.os.fsync", synced.append)
+        with TraceWriter(tmp_path / "traces.jsonl", batch_size=1, fsync=True) as w:
+            w.add(traced_state("t1"))
+            assert len(synced) == 1
+        n = len(synced)
+        with TraceWriter(tmp_path / "traces.jsonl", batch_size=1) as w:
+            w.add(traced_state("t2"))
+        assert len(synced) == n
+
+    def test_empty_flush_skips_fsync(self, tmp_path, monkeypatch):
+        synced = []
+        monkeypatch.setattr("tinyagent.tracing.os.fsync", synced.append)
+        with TraceWriter(tmp_path / "traces.jsonl", fsync=True) as w:
+            w.flush()
+        assert synced == []
+
+    def test_failed_write_keeps_buffer(self, tmp_path):
+        def fail(data): raise OSError("disk full")
+        with TraceWriter(tmp_path / "traces.jsonl") as w:
+            w.add(traced_state("t1"))
+            w._write = fail
+            with pytest.raises(OSError, match="disk full"):
+                w.flush()
+            assert len(w._buf) == 1
+            del w._write   # recovered: the records go out with the next flush
+        assert [t["trace_id"] for t in read_traces(tmp_path / "traces.jsonl")] == ["t1"]
+
+    def test_requires_context_manager(self, tmp_path):
+        with pytest.raises(RuntimeError, match="context manager"):
+            TraceWriter(tmp_path / "x.jsonl").add(State())
+
+    def test_invalid_batch_size(self, tmp_path):
+        with pytest.raises(ValueError, match="batch_size must be > 0"):
+            TraceWriter(tmp_path / "x.jsonl", batch_size=0)
+
+
+class TestBackgroundTraceWriter:
+    def setup_method(self):
+        Node._registry.clear()
+
+    def test_writes_everything_on_exit(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        with BackgroundTraceWriter(path, batch_size=2) as w:
+            for i in range(5):
+                w.add(traced_state(f"t{i}"))
+        assert [t["trace_id"] for t in read_traces(path)] == [f"t{i}" for i in range(5)]
+
+    def test_io_runs_off_the_calling_thread(self, tmp_path, monkeypatch):
+        threads = []
+        monkeypatch.setattr("tinyagent.tracing.os.fsync", lambda fd: threads.append(threading.current_thread()))
+        with BackgroundTraceWriter(tmp_path / "traces.jsonl", batch_size=1, fsync=True) as w:
+            w.add(traced_state("t1"))
+        assert threads and threading.current_thread() not in threads
+
+    def test_write_error_raised_on_exit(self, tmp_path, monkeypatch):
+        def fail(fd): raise OSError("disk full")
+        monkeypatch.setattr("tinyagent.tracing.os.fsync", fail)
+        with pytest.raises(OSError, match="disk full"):
+            with BackgroundTraceWriter(tmp_path / "traces.jsonl", fsync=True) as w:
+                w.add(traced_state("t1"))
+        assert w._fh is None
+
+    def test_requires_context_manager(self, tmp_path):
+        with pytest.raises(RuntimeError, match="context manager"):
+            BackgroundTraceWriter(tmp_path / "x.jsonl").add(State())
+
+
+class TestReadTraces:
+    def setup_method(self):
+        Node._registry.clear()
+
+    def test_round_trip(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        with TraceWriter(path) as w:
+            w.add(traced_state("t1"))
+            w.add(traced_state("t2"))
+        traces = read_traces(path)
+        first = next(traces)
+        assert first["trace_id"] == "t1"
+        assert [(e["name"], e["status"]) for e in first["events"]] == [("start", None), ("a", "OK"), ("b", "ERR")]
+        assert [t["trace_id"] for t in traces] == ["t2"]
+
+    def test_skips_blank_lines(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        path.write_text('{"trace_id": "x", "events": []}\n\n')
+        assert list(read_traces(path)) == [{"trace_id": "x", "events": []}]
+
+
+class TestToGraph:
+    def setup_method(self):
+        Node._registry.clear()
+
+    def test_edges_follow_execution_order(self):
+        async def _run():
+            async def gen(state): return True
+            async def rev(state): return len(state.trace) >= 4
+            Node("gen", gen); Node("rev", rev)
+            state = State(max_trace=100)
+            state.log("start")
+            await Flow().run("gen <3> rev", state)
+            return state
+        names, src, dst = to_graph(asyncio.run(_run()).trace)
+        assert names == ["gen", "rev"]
+        assert list(zip(src, dst)) == [(0, 1), (1, 0), (0, 1)]
+        assert src.typecode == dst.typecode == "q"
+
+    def test_loaded_trace(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        state = traced_state("t1")
+        with TraceWriter(path) as w:
+            w.add(state)
+        loaded, = read_traces(path)
+        names, src, dst = to_graph(loaded)
+        assert (names, list(src), list(dst)) == (["a", "b"], [0], [1])
+        assert to_graph(state.trace)[0] == names
+
+    def test_single_execution_has_no_edges(self):
+        names, src, dst = to_graph([(0.0, "a", 0, 5, None)])
+        assert names == ["a"] and len(src) == len(dst) == 0
+
+    def test_empty_trace(self):
+        names, src, dst = to_graph(State().trace)
+        assert names == [] and len(src) == len(dst) == 0